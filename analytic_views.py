@@ -0,0 +1,133 @@
+"""
+analytic_views.py
+
+Views and materialized aggregates over the IRPF DuckDB tables, shared by the
+personal-documents rebuild (meus_arquivos/db_arquivos_pessoais.py), which
+builds them right after loading the tables, and by server.py, which rebuilds
+them on connect when needed. Keeping the definitions here means both read the
+same income and asset figures.
+"""
+
+import logging
+
+import duckdb
+
+logger = logging.getLogger("IRPF_MCP")
+
+# The aggregates (mv_*) are materialized as tables and only rebuilt when the
+# source tables were reloaded since they were last built (see
+# create_analytic_views); the plain views are recreated every time.
+ANALYTIC_VIEWS = {
+    "v_salary_income": """
+    CREATE OR REPLACE VIEW v_salary_income AS
+    SELECT d.file_name, r.nome_fonte_pagadora, r.rendimentos
+    FROM rendimentos_tributaveis_pj r
+    JOIN declarations d ON r.declaration_id = d.declaration_id
+    """,
+    "mv_payments_by_category": """
+    CREATE OR REPLACE TABLE mv_payments_by_category AS
+    SELECT codigo, SUM(valor_pago) as total_value
+    FROM pagamentos_efetuados
+    GROUP BY codigo
+    """,
+    "mv_assets_by_grupo": """
+    CREATE OR REPLACE TABLE mv_assets_by_grupo AS
+    SELECT
+        grupo,
+        COUNT(*) as count,
+        SUM(valor_2023) as total_value_2023,
+        SUM(valor_2024) as total_value_2024,
+        AVG(valor_2024) as avg_value_2024,
+        MIN(valor_2024) as min_value_2024,
+        MAX(valor_2024) as max_value_2024,
+        SUM(valor_2024 - valor_2023) as value_change,
+        (SUM(valor_2024) - SUM(valor_2023)) / NULLIF(SUM(valor_2023), 0) * 100 as percent_change
+    FROM bens_direitos
+    GROUP BY grupo
+    """,
+    # Every income row, including isentos without a paying source; callers
+    # filter or relabel as they need
+    "v_all_income_sources": """
+    CREATE OR REPLACE VIEW v_all_income_sources AS
+    WITH
+    tributaveis AS (
+        SELECT
+            'Tributável PJ' as tipo,
+            nome_fonte_pagadora as fonte,
+            rendimentos as valor
+        FROM rendimentos_tributaveis_pj
+    ),
+    exclusivos AS (
+        SELECT
+            'Exclusivo' as tipo,
+            nome_fonte_pagadora as fonte,
+            valor
+        FROM rendimentos_exclusivos
+    ),
+    isentos AS (
+        SELECT
+            'Isento' as tipo,
+            nome_fonte_pagadora as fonte,
+            valor
+        FROM rendimentos_isentos
+    )
+
+    SELECT * FROM tributaveis
+    UNION ALL
+    SELECT * FROM exclusivos
+    UNION ALL
+    SELECT * FROM isentos
+    """,
+}
+
+def _read_meta(conn, key):
+    """Read a value from irpf_meta, or None if the table or key is missing."""
+    try:
+        row = conn.execute("SELECT value FROM irpf_meta WHERE key = ?", [key]).fetchone()
+    except duckdb.CatalogException:
+        return None
+    return row[0] if row else None
+
+def create_analytic_views(conn):
+    """
+    (Re)build the views and materialized aggregates in ANALYTIC_VIEWS.
+    A view whose source tables are missing is skipped with a warning.
+
+    The personal-documents rebuild stamps irpf_meta.source_build; the mv_*
+    tables are refreshed only when that stamp differs from the one recorded
+    at their last refresh (or when no stamp exists).
+
+    Args:
+        conn: DuckDB connection (not read-only)
+
+    Returns:
+        set: Names of the ANALYTIC_VIEWS entries available on the connection
+    """
+    source_build = _read_meta(conn, "source_build")
+    refresh_mv = source_build is None or _read_meta(conn, "mv_build") != source_build
+
+    available = set()
+    mv_ok = True
+    for name, ddl in ANALYTIC_VIEWS.items():
+        is_mv = name.startswith("mv_")
+        if is_mv and not refresh_mv:
+            if conn.execute(
+                "SELECT 1 FROM duckdb_tables() WHERE schema_name = 'main' AND table_name = ?", [name]
+            ).fetchone():
+                available.add(name)
+                continue
+            refresh_mv = True
+        try:
+            conn.execute(ddl)
+            available.add(name)
+        except duckdb.CatalogException as e:
+            mv_ok = mv_ok and not is_mv
+            logger.warning(f"Skipping {name}, source tables are missing: {e}")
+        except Exception as e:
+            mv_ok = mv_ok and not is_mv
+            logger.warning(f"Could not create {name}: {e}")
+
+    if refresh_mv and mv_ok and source_build is not None:
+        conn.execute("INSERT OR REPLACE INTO irpf_meta VALUES ('mv_build', ?)", [source_build])
+
+    return available
@@ -9,20 +9,23 @@ import sys
 from pathlib import Path
 sys.path.append(str(Path(__file__).resolve().parent.parent))
 
-from llama_index.core import SimpleDirectoryReader
-from llama_index.llms.openai import OpenAI
-from llama_index.embeddings.openai import OpenAIEmbedding
-from llama_cloud_services import LlamaParse
-import nest_asyncio, os, json
-from tqdm import tqdm
-from llama_index.core import SQLDatabase, SimpleDirectoryReader, Document
-from llama_index.core.query_engine import NLSQLTableQueryEngine
-from llama_index.core.indices.struct_store import SQLTableRetrieverQueryEngine
+import os, json, asyncio, hashlib, time
 import pandas as pd
+import pyarrow as pa
 from decimal import Decimal
 import duckdb
 
-def process_personal_documents(source_folder=None, force_processing=False, num_retries=3):
+from analytic_views import create_analytic_views
+
+# Money fields of the IRPF schema. The structured cache holds pydantic JSON, which
+# writes Decimal as strings, so these columns are converted to numbers before loading
+MONEY_COLUMNS = {
+    "valor", "valor_pago", "parcela_nao_dedutivel", "valor_2023", "valor_2024",
+    "rendimentos", "contribuicao_previdenciaria", "imposto_retido",
+    "decimo_terceiro", "irrf_decimo_terceiro",
+}
+
+def process_personal_documents(source_folder=None, force_processing=False, num_retries=3, max_concurrency=8):
     """
     Process personal documents from PDF files and create a database.
     
@@ -31,10 +34,22 @@ def process_personal_documents(source_folder=None, force_processing=False, num_r
                                               Defaults to "meus_arquivos" in the current directory.
         force_processing (bool, optional): Force processing even if no new files are detected.
                                           Defaults to False.
+        max_concurrency (int, optional): Maximum number of concurrent LLM requests.
+                                         Defaults to 8.
     
     Returns:
         bool: True if processing was performed, False otherwise
     """
+    # The parsing/LLM stack is only needed here; importing it lazily keeps the
+    # query helpers below cheap to import
+    from llama_index.core import SimpleDirectoryReader, Document
+    from llama_index.llms.openai import OpenAI
+    from llama_cloud_services import LlamaParse
+    from tqdm.asyncio import tqdm_asyncio
+    from IRPF_schema import DeclaracaoIRPF2025
+    import nest_asyncio
+    import httpx
+    
     nest_asyncio.apply()
     
     # Set default source folder if not provided
@@ -112,26 +127,59 @@ def process_personal_documents(source_folder=None, force_processing=False, num_r
         with open(processed_marker, "r") as f:
             dir_reader = [Document.from_dict(x) for x in json.load(f)]
     
-    from llama_index.llms.openai import OpenAI
-    from IRPF_schema import DeclaracaoIRPF2025
-    
-    llm = OpenAI(model="gpt-4.1-2025-04-14")
-    sllm = llm.as_structured_llm(DeclaracaoIRPF2025)
-    
-    result = []
-    for i in tqdm(dir_reader, total=len(dir_reader)):
-        for retry in range(num_retries):
-            try:
-                result.append(sllm.complete(i.text))
-                break
-            except Exception as e:
-                print(f"Error processing document {i.metadata['file_name']}: {e}")
-                print(f"Retrying ({retry + 1}/{num_retries})...")
-    
-    irpf = [json.loads(x.text) for x in result]
-    for i, resp in enumerate(irpf):
-        for k, v in dir_reader[i].metadata.items():
-            resp[k] = v
+    # Structured LLM outputs are cached by the SHA-256 of the document text,
+    # so re-runs only send new or changed documents to the LLM
+    structured_cache_path = data_files / "structured_cache.json"
+    structured_cache = {}
+    if structured_cache_path.exists():
+        with open(structured_cache_path, "r", encoding="utf-8") as f:
+            structured_cache = json.load(f)
+    
+    doc_hashes = [hashlib.sha256(doc.text.encode("utf-8")).hexdigest() for doc in dir_reader]
+    pending = {h: doc for h, doc in zip(doc_hashes, dir_reader) if h not in structured_cache}
+    print(f"{len(dir_reader) - len(pending)} documents cached, {len(pending)} to send to the LLM")
+    
+    async def structure_document(sllm, doc, semaphore):
+        async with semaphore:
+            for retry in range(num_retries):
+                try:
+                    response = await sllm.acomplete(doc.text)
+                    return json.loads(response.text)
+                except Exception as e:
+                    print(f"Error processing document {doc.metadata['file_name']}: {e}")
+                    print(f"Retrying ({retry + 1}/{num_retries})...")
+            return None
+    
+    async def structure_pending_documents():
+        # Share one pooled HTTP client across all LLM calls so each document
+        # doesn't pay a fresh TCP/TLS handshake
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32)
+        )
+        try:
+            llm = OpenAI(model="gpt-4.1-2025-04-14", async_http_client=http_client)
+            sllm = llm.as_structured_llm(DeclaracaoIRPF2025)
+            semaphore = asyncio.Semaphore(max_concurrency)
+            return await tqdm_asyncio.gather(
+                *(structure_document(sllm, doc, semaphore) for doc in pending.values())
+            )
+        finally:
+            await http_client.aclose()
+    
+    if pending:
+        responses = asyncio.run(structure_pending_documents())
+        for h, resp in zip(pending, responses):
+            if resp is not None:
+                structured_cache[h] = resp
+        with open(structured_cache_path, "w", encoding="utf-8") as f:
+            json.dump(structured_cache, f, ensure_ascii=False)
+    
+    irpf = []
+    for h, doc in zip(doc_hashes, dir_reader):
+        if h in structured_cache:
+            resp = dict(structured_cache[h])
+            resp.update(doc.metadata)
+            irpf.append(resp)
     
     # Convert irpf from json/dict into a queryable database using DuckDB
     
@@ -253,30 +301,18 @@ def process_personal_documents(source_folder=None, force_processing=False, num_r
             # For each item, assign the declaration ID based on its position in the flattened list
             df['declaration_id'] = df.index % len(irpf) if len(irpf) > 0 else 0
     
+    # Money values arrive as JSON strings ("2000.50"); without this Arrow would
+    # load them as VARCHAR and SUM/ORDER BY on them would fail or sort as text
+    for df in (bens_df, doacoes_df, pagto_df, rexcl_df, risento_df, rtrib_pj_df):
+        money_cols = [col for col in df.columns if col in MONEY_COLUMNS]
+        if money_cols:
+            df[money_cols] = df[money_cols].apply(pd.to_numeric, errors="coerce")
+    
     # Create DuckDB database
     duck_db_path = db_dir / "irpf_database.duckdb"
-    duck_conn = duckdb.connect(str(duck_db_path))
-    '''
-    # Register DataFrames as tables in DuckDB
-    duck_conn.register('bens_df', bens_df)
-    duck_conn.register('doacoes_df', doacoes_df)
-    duck_conn.register('pagto_df', pagto_df)
-    duck_conn.register('rexcl_df', rexcl_df)
-    duck_conn.register('risento_df', risento_df)
-    duck_conn.register('rtrib_pj_df', rtrib_pj_df)
-    duck_conn.register('declarations_df', declarations_df)
-    
-    # Create persistent tables in the database
-    duck_conn.execute("CREATE OR REPLACE TABLE bens_direitos AS SELECT * FROM bens_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE doacoes_efetuadas AS SELECT * FROM doacoes_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE pagamentos_efetuados AS SELECT * FROM pagto_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_exclusivos AS SELECT * FROM rexcl_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_isentos AS SELECT * FROM risento_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_tributaveis_pj AS SELECT * FROM rtrib_pj_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE declarations AS SELECT * FROM declarations_df")
-    '''
+    duck_conn = duckdb.connect(str(duck_db_path), config={"threads": os.cpu_count() or 1})
 
-    # Save DataFrames as CSVs in data_files before uploading to DuckDB
+    # Save DataFrames as CSVs in data_files alongside the database
     data_files_dir = db_dir / "data_files"
     data_files_dir.mkdir(exist_ok=True)
     bens_csv = data_files_dir / "bens_direitos.csv"
@@ -295,23 +331,47 @@ def process_personal_documents(source_folder=None, force_processing=False, num_r
     rtrib_pj_df.to_csv(rtrib_pj_csv, index=False)
     declarations_df.to_csv(declarations_csv, index=False)
 
-    # Register CSVs as tables in DuckDB
-    duck_conn.execute(f"CREATE OR REPLACE TABLE bens_df AS SELECT * FROM read_csv_auto('{bens_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE doacoes_df AS SELECT * FROM read_csv_auto('{doacoes_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE pagto_df AS SELECT * FROM read_csv_auto('{pagto_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE rexcl_df AS SELECT * FROM read_csv_auto('{rexcl_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE risento_df AS SELECT * FROM read_csv_auto('{risento_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE rtrib_pj_df AS SELECT * FROM read_csv_auto('{rtrib_pj_csv}')")
-    duck_conn.execute(f"CREATE OR REPLACE TABLE declarations_df AS SELECT * FROM read_csv_auto('{declarations_csv}')")
-
-    # Create persistent tables in the database
-    duck_conn.execute("CREATE OR REPLACE TABLE bens_direitos AS SELECT * FROM bens_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE doacoes_efetuadas AS SELECT * FROM doacoes_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE pagamentos_efetuados AS SELECT * FROM pagto_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_exclusivos AS SELECT * FROM rexcl_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_isentos AS SELECT * FROM risento_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE rendimentos_tributaveis_pj AS SELECT * FROM rtrib_pj_df")
-    duck_conn.execute("CREATE OR REPLACE TABLE declarations AS SELECT * FROM declarations_df")
+    # Rebuild every table inside a single transaction: one commit instead of one per statement
+    duck_conn.execute("BEGIN TRANSACTION")
+    
+    # Load each DataFrame through Arrow, which DuckDB scans without copying and
+    # which keeps the pandas dtypes: numeric money columns load as DOUBLE and
+    # text columns as VARCHAR, like the CSV inference did, and the numeric
+    # columns of empty schedules keep their declared dtypes (a header-only CSV
+    # would come back as VARCHAR). Also drop the *_df staging copies older
+    # builds kept in the database.
+    for table_name, df, staging_name in [
+        ("bens_direitos", bens_df, "bens_df"),
+        ("doacoes_efetuadas", doacoes_df, "doacoes_df"),
+        ("pagamentos_efetuados", pagto_df, "pagto_df"),
+        ("rendimentos_exclusivos", rexcl_df, "rexcl_df"),
+        ("rendimentos_isentos", risento_df, "risento_df"),
+        ("rendimentos_tributaveis_pj", rtrib_pj_df, "rtrib_pj_df"),
+        ("declarations", declarations_df, "declarations_df"),
+    ]:
+        stage = pa.Table.from_pandas(df, preserve_index=False)
+        # A text column with no values (all null, or an empty schedule) comes
+        # through as Arrow null, which DuckDB would load as INTEGER
+        stage = stage.cast(pa.schema(
+            [pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f for f in stage.schema],
+            metadata=stage.schema.metadata,
+        ))
+        duck_conn.register("stage", stage)
+        duck_conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM stage")
+        duck_conn.unregister("stage")
+        duck_conn.execute(f"DROP TABLE IF EXISTS {staging_name}")
+    
+    # Stamp the rebuild so the server knows its materialized aggregates are stale
+    duck_conn.execute("CREATE TABLE IF NOT EXISTS irpf_meta (key VARCHAR PRIMARY KEY, value VARCHAR)")
+    duck_conn.execute("INSERT OR REPLACE INTO irpf_meta VALUES ('source_build', ?)", [str(time.time_ns())])
+    
+    duck_conn.execute("COMMIT")
+    
+    # Views and aggregates shared with the server (analytic_views.py), built
+    # after the commit so a view that fails to bind cannot roll back the tables
+    create_analytic_views(duck_conn)
+    
+    duck_conn.close()
 
     print(f"DuckDB database created at: {duck_db_path}")
 
@@ -325,28 +385,29 @@ def query_irpf_db(sql_query):
         sql_query (str): SQL query to execute
         
     Returns:
-        pandas.DataFrame: Result of the query
+        pyarrow.Table: Result of the query (call .to_pandas() if a DataFrame is needed)
     """
     db_dir = Path("/home/kenski/projects/IRPF_MCP/database")
     duck_db_path = db_dir / "irpf_database.duckdb"
     
     if not duck_db_path.exists():
         print(f"Database file not found at {duck_db_path}")
-        return pd.DataFrame()
+        return pa.table({})
     
     try:
-        conn = duckdb.connect(str(duck_db_path))
-        return conn.execute(sql_query).fetchdf()
+        # Arrow keeps DuckDB's columnar result as is; no pandas object columns
+        with duckdb.connect(str(duck_db_path), read_only=True) as conn:
+            return conn.execute(sql_query).fetch_arrow_table()
     except Exception as e:
         print(f"Error executing query: {e}")
-        return pd.DataFrame()
+        return pa.table({})
 
 def find_salary_income():
     """
     Find all salary income records in the database.
     
     Returns:
-        pandas.DataFrame: Salary income records
+        pyarrow.Table: Salary income records
     """
     query = """
     SELECT d.file_name, r.nome_fonte_pagadora, r.rendimentos
@@ -361,7 +422,7 @@ def total_payments_by_category():
     Calculate total payments by category.
     
     Returns:
-        pandas.DataFrame: Total payments by category
+        pyarrow.Table: Total payments by category
     """
     query = """
     SELECT codigo, SUM(valor_pago) as total_pago
@@ -376,18 +437,17 @@ def analyze_assets():
     Analyze assets by group and calculate value changes.
     
     Returns:
-        pandas.DataFrame: Asset analysis
+        pyarrow.Table: Asset analysis
     """
     query = """
     SELECT 
-        grupo, 
-        COUNT(*) as num_assets,
-        SUM(valor_2023) as total_2023,
-        SUM(valor_2024) as total_2024,
-        SUM(valor_2024 - valor_2023) as value_change,
-        (SUM(valor_2024) - SUM(valor_2023)) / NULLIF(SUM(valor_2023), 0) * 100 as percent_change
-    FROM bens_direitos
-    GROUP BY grupo
+        grupo,
+        "count" as num_assets,
+        total_value_2023 as total_2023,
+        total_value_2024 as total_2024,
+        value_change,
+        percent_change
+    FROM mv_assets_by_grupo
     ORDER BY total_2024 DESC
     """
     return query_irpf_db(query)
@@ -397,44 +457,15 @@ def all_income_sources():
     Find all income sources across different income types.
     
     Returns:
-        pandas.DataFrame: All income sources
+        pyarrow.Table: All income sources
     """
     query = """
-    WITH 
-    tributaveis AS (
-        SELECT 
-            'Tributável' as tipo_rendimento,
-            nome_fonte_pagadora,
-            rendimentos as valor
-        FROM rendimentos_tributaveis_pj
-    ),
-    isentos AS (
-        SELECT 
-            'Isento' as tipo_rendimento,
-            nome_fonte_pagadora,
-            valor
-        FROM rendimentos_isentos
-    ),
-    exclusivos AS (
-        SELECT 
-            'Exclusivo' as tipo_rendimento,
-            nome_fonte_pagadora,
-            valor
-        FROM rendimentos_exclusivos
-    ),
-    all_sources AS (
-        SELECT * FROM tributaveis
-        UNION ALL
-        SELECT * FROM isentos
-        UNION ALL
-        SELECT * FROM exclusivos
-    )
     SELECT 
-        nome_fonte_pagadora,
-        tipo_rendimento,
+        fonte as nome_fonte_pagadora,
+        CASE tipo WHEN 'Tributável PJ' THEN 'Tributável' ELSE tipo END as tipo_rendimento,
         SUM(valor) as total_valor
-    FROM all_sources
-    GROUP BY nome_fonte_pagadora, tipo_rendimento
+    FROM v_all_income_sources
+    GROUP BY fonte, tipo
     ORDER BY total_valor DESC
     """
     return query_irpf_db(query)
@@ -1,34 +1,91 @@
 from mcp.server.fastmcp import FastMCP
 from pathlib import Path
+import os
 import yaml
+try:
+    # libyaml C bindings when available; same semantics as yaml.safe_load
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import json
 import logging
-import chromadb
-from llama_index.core import VectorStoreIndex
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index.embeddings.openai import OpenAIEmbedding
+import logging.handlers
+import queue
+import atexit
 import time
+import asyncio
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+import copy
+import contextlib
+import hashlib
+from array import array
 import duckdb
-import pandas as pd
 from xml2Pydantic import parse_irpf2025
+from analytic_views import create_analytic_views
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging. Records go through a queue and are written by a listener
+# thread, so tool calls never block on the stderr write.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(_log_queue)])
 logger = logging.getLogger("IRPF_MCP")
 
 # Create MCP server
 mcp = FastMCP("IRPF_MCP")
 
-# Load configuration immediately
-def load_config():
-    import os
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(base_dir, "setup.yaml")
+# Parsed configs keyed by absolute path, validated against (mtime_ns, size)
+_config_cache = OrderedDict()
+_CONFIG_CACHE_SIZE = 8
+
+def _read_config_file(config_path, mtime_ns):
+    """
+    Parse setup.yaml through a JSON sidecar (setup.yaml.json). The sidecar is
+    used while it is at least as new as the YAML; otherwise the YAML is parsed
+    and the sidecar rewritten (best effort, e.g. on a read-only checkout).
+    """
+    json_path = config_path + ".json"
     try:
-        with open(config_path, "r", encoding="utf-8") as file:
-            config = yaml.safe_load(file)
-            logger.info(f"Loaded configuration from {config_path}")
-            return config
+        if os.stat(json_path).st_mtime_ns >= mtime_ns:
+            with open(json_path, "r", encoding="utf-8") as file:
+                return json.load(file)
+    except (OSError, ValueError):
+        pass
+    
+    # Binary handle: the loader decodes the UTF-8 bytes itself
+    with open(config_path, "rb") as file:
+        config = yaml.load(file, Loader=SafeLoader)
+    try:
+        payload = json.dumps(config, ensure_ascii=False)
+        with open(json_path, "w", encoding="utf-8") as file:
+            file.write(payload)
+    except (OSError, TypeError) as e:
+        logger.warning(f"Could not write config cache {json_path}: {e}")
+    return config
+
+def load_config(config_path=None):
+    if config_path is None:
+        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "setup.yaml")
+    config_path = os.path.abspath(config_path)
+    try:
+        st = os.stat(config_path)
+        cached = _config_cache.get(config_path)
+        if cached is not None and cached[:2] == (st.st_mtime_ns, st.st_size):
+            _config_cache.move_to_end(config_path)
+            # Callers get their own copy so mutations can't corrupt the cache
+            return copy.deepcopy(cached[2])
+        
+        config = _read_config_file(config_path, st.st_mtime_ns)
+        logger.info(f"Loaded configuration from {config_path}")
+        
+        _config_cache[config_path] = (st.st_mtime_ns, st.st_size, config)
+        _config_cache.move_to_end(config_path)
+        while len(_config_cache) > _CONFIG_CACHE_SIZE:
+            _config_cache.popitem(last=False)
+        return copy.deepcopy(config)
     except FileNotFoundError:
         logger.error(f"setup.yaml not found at {config_path}. Please ensure the file exists and is readable.")
         raise
@@ -40,6 +97,15 @@ def load_config():
 config = load_config()
 logger.info(f"Configuration loaded: IRPF_DIR={config.get('IRPF_DIR_2025')}, CPF={config.get('CPF')}")
 
+# Tax return XML exported by the IRPF program, resolved once at startup.
+# Without IRPF_DIR_2025 the tax return tools report an error instead of
+# falling back to some other path
+if config.get('IRPF_DIR_2025'):
+    IR_XML_PATH = Path(str(config['IRPF_DIR_2025'])).expanduser()
+else:
+    IR_XML_PATH = None
+    logger.error("IRPF_DIR_2025 is not set in setup.yaml; the tax return tools will report an error")
+
 # Global variables for ChromaDB
 chroma_client = None
 chroma_collection = None
@@ -47,15 +113,26 @@ vector_store = None
 index = None
 query_engine = None
 embed_model = None
+# Serializes (re)initialization so concurrent calls don't each build an index
+_chroma_lock = threading.Lock()
+# In-memory copy of the collection for the retrieval tools, see _get_flat_index
+_flat_index = None
+_flat_index_lock = threading.Lock()
 
 # Global variables for DuckDB
 duck_conn = None
 
 # Initialize ChromaDB client
 def initialize_chroma_client():
-    global chroma_client, chroma_collection, vector_store, index, query_engine, embed_model
+    global chroma_client, chroma_collection, vector_store, index, query_engine, embed_model, _flat_index
     
     try:
+        # Heavy imports, deferred until the knowledge base is first needed
+        import chromadb
+        from llama_index.core import VectorStoreIndex
+        from llama_index.vector_stores.chroma import ChromaVectorStore
+        from llama_index.embeddings.openai import OpenAIEmbedding
+        
         # Initialize embedding model if not already done
         if embed_model is None:
             embed_model = OpenAIEmbedding(model="text-embedding-3-large")
@@ -63,6 +140,7 @@ def initialize_chroma_client():
         # Connect to existing ChromaDB
         chroma_client = chromadb.PersistentClient(path=config['PROJECT_FOLDER'] + "/knowledge_base/chroma_db")
         chroma_collection = chroma_client.get_or_create_collection("IRPF")
+        _flat_index = None
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         index = VectorStoreIndex.from_vector_store(
             vector_store,
@@ -76,6 +154,10 @@ def initialize_chroma_client():
         chroma_client = None
         query_engine = None
 
+# Names of the ANALYTIC_VIEWS entries built on the current connection, so the
+# tools can tell a missing source table apart from an empty result
+_available_views = set()
+
 # Initialize DuckDB connection
 def initialize_db_connection():
     global duck_conn, config
@@ -98,22 +180,40 @@ def initialize_db_connection():
             logger.info(f"Database file exists at {duck_db_path}, size: {duck_db_path.stat().st_size} bytes")
         
         logger.info(f"Connecting to DuckDB at {duck_db_path}")
-        conn = duckdb.connect(str(duck_db_path))
+        # Use every core for the aggregate tools; memory_limit stays at DuckDB's
+        # default unless DUCKDB_MEMORY_LIMIT is set in setup.yaml
+        duck_config = {"threads": os.cpu_count() or 1, "enable_object_cache": True}
+        if config.get('DUCKDB_MEMORY_LIMIT'):
+            duck_config["memory_limit"] = str(config['DUCKDB_MEMORY_LIMIT'])
+        conn = duckdb.connect(str(duck_db_path), config=duck_config)
         logger.info(f"Connected to DuckDB at {duck_db_path}")
         
         # Test the connection
-        test_result = conn.execute("SELECT 1 as test").fetchdf()
+        test_result = conn.execute("SELECT 1 as test").fetchall()
         logger.info(f"Connection test result: {test_result}")
         
+        # Views/tables backing the analytic tools; the mv_* aggregates are
+        # usually already current, built by the personal-documents rebuild
+        _available_views.clear()
+        _available_views.update(create_analytic_views(conn))
+        
         return conn
     except Exception as e:
         logger.error(f"Error connecting to database: {e}")
         logger.exception("Detailed exception information:")
         return None
 
+# Parsed tax return cache: the key includes mtime and size, so saving the
+# declaration in the IRPF program invalidates it
+@lru_cache(maxsize=1)
+def _load_tax_return_json(xml_path: str, mtime_ns: int, size: int) -> str:
+    decl = parse_irpf2025(xml_path)
+    # Serialize straight from pydantic-core instead of model_dump() + json.dumps()
+    return decl.model_dump_json(indent=2)
+
 # Resource function for reading tax return
 @mcp.tool()
-def read_tax_return():
+async def read_tax_return():
     """
     Reads the current tax return XML file.
 
@@ -121,22 +221,35 @@ def read_tax_return():
         str: JSON representation of the tax return
     """
     try:
-        ir_xml = Path(config['IRPF_DIR_2025'])
-        if str(ir_xml).startswith('~'):
-            ir_xml = ir_xml.expanduser()
+        ir_xml = IR_XML_PATH
+        if ir_xml is None:
+            return json.dumps({"error": "IRPF_DIR_2025 is not set in setup.yaml"}, indent=2, ensure_ascii=False)
         logger.info(f"Reading tax return from {ir_xml}")
         
-        if not ir_xml.exists():
+        try:
+            st = ir_xml.stat()
+        except FileNotFoundError:
             logger.error(f"Tax return file not found: {ir_xml}")
             return json.dumps({"error": "Tax return file not found"}, indent=2, ensure_ascii=False)
         
-        decl = parse_irpf2025(ir_xml)
-        return json.dumps(decl.model_dump(mode="json"), indent=2, ensure_ascii=False)
+        # Parsing a large declaration can take a while; keep the event loop free
+        return await asyncio.to_thread(_load_tax_return_json, str(ir_xml), st.st_mtime_ns, st.st_size)
     except Exception as e:
         logger.error(f"Error reading tax return: {e}")
         return json.dumps({"error": f"Failed to read tax return: {str(e)}"}, indent=2, ensure_ascii=False)
 
-'''
+# Constant parts of the check_tax_return_status replies
+_STATUS_DISPONIVEL = {
+    "status": "disponível",
+    "arquivo": str(IR_XML_PATH),
+    "mensagem": "A declaração está disponível para acesso"
+}
+_STATUS_INDISPONIVEL = {
+    "status": "indisponível",
+    "arquivo": str(IR_XML_PATH),
+    "mensagem": "O arquivo da declaração não foi encontrado"
+}
+
 # Tool function for checking tax return status
 @mcp.tool()
 def check_tax_return_status():
@@ -147,209 +260,463 @@ def check_tax_return_status():
         dict: Status of the tax return with basic information.
     """
     logger.info("Verificando status da declaração")
+    if IR_XML_PATH is None:
+        return {
+            "status": "erro",
+            "mensagem": "IRPF_DIR_2025 não está definido no setup.yaml"
+        }
     try:
-        # Try to access the XML file
-        ir_xml = Path(config['IRPF_DIR_2025'])
-        
-        if ir_xml.exists():
-            file_size = ir_xml.stat().st_size
-            file_modified = ir_xml.stat().st_mtime
-            
-            return {
-                "status": "disponível",
-                "arquivo": str(ir_xml),
-                "tamanho": f"{file_size / 1024:.2f} KB",
-                "ultima_modificacao": file_modified,
-                "mensagem": "A declaração está disponível para acesso"
-            }
-        else:
-            return {
-                "status": "indisponível",
-                "arquivo": str(ir_xml),
-                "mensagem": "O arquivo da declaração não foi encontrado"
-            }
+        # A single stat() gives existence, size and modification time
+        st = os.stat(IR_XML_PATH)
+    except FileNotFoundError:
+        return dict(_STATUS_INDISPONIVEL)
     except Exception as e:
         logger.error(f"Erro ao verificar status: {e}")
         return {
             "status": "erro",
             "mensagem": f"Erro ao verificar o status da declaração: {str(e)}"
         }
-
-          "check_tax_return_status": {
-            "category": "XML_TAX_RETURN",
-            "description": "Checks if the tax return is available and accessible (XML source)",
-            "parameters": [],
-            "returns": {
-              "type": "object",
-              "description": "Status of the tax return with basic information"
-            }
-          },
-        '''
+    
+    return {
+        **_STATUS_DISPONIVEL,
+        "tamanho": f"{st.st_size >> 10} KB",
+        "ultima_modificacao": st.st_mtime,
+    }
         
-# Tool function for querying the database
-@mcp.tool()
-def query_irpf_db(sql_query: str):
+# Pool of cursors over the shared connection: each tool call borrows its own
+# cursor, so concurrent calls don't share one connection's state. Every cursor
+# carries its own cache of parsed relations for the fixed analytic queries,
+# keyed by SQL text, so repeated tool calls skip SQL parsing and binding.
+DB_POOL_SIZE = os.cpu_count() or 1
+_cursor_pool = None
+_db_lock = threading.Lock()
+
+def _get_cursor_pool():
+    """
+    Return the cursor pool, opening the DuckDB connection first if needed.
+    
+    Returns:
+        queue.Queue | None: (cursor, relation_cache) pairs, or None if the
+        database could not be opened
+    """
+    global duck_conn, _cursor_pool
+    
+    if _cursor_pool is None:
+        with _db_lock:
+            if _cursor_pool is None:
+                if duck_conn is None:
+                    logger.info("DuckDB connection is None, initializing...")
+                    duck_conn = initialize_db_connection()
+                    if duck_conn is None:
+                        logger.error("Failed to initialize DuckDB connection")
+                        return None
+                pool = queue.Queue(maxsize=DB_POOL_SIZE)
+                for _ in range(DB_POOL_SIZE):
+                    pool.put((duck_conn.cursor(), {}))
+                _cursor_pool = pool
+    return _cursor_pool
+
+# Rows per Arrow record batch when streaming ad-hoc query results
+QUERY_BATCH_ROWS = 8192
+
+# Statement types that cannot change the tables behind the mv_* aggregates;
+# any other ad-hoc statement triggers a refresh (see _refresh_aggregates)
+_READ_ONLY_STATEMENTS = {
+    duckdb.StatementType.SELECT,
+    duckdb.StatementType.EXPLAIN,
+    duckdb.StatementType.PRAGMA,
+    duckdb.StatementType.SET,
+    duckdb.StatementType.VARIABLE_SET,
+}
+
+def _refresh_aggregates(cursor):
+    """
+    Rebuild the mv_* aggregates after ad-hoc SQL may have changed their source
+    tables. mv_build is cleared first, so if the rebuild fails the next connect
+    retries it instead of keeping the stale tables.
+    """
+    with contextlib.suppress(duckdb.CatalogException):
+        cursor.execute("DELETE FROM irpf_meta WHERE key = 'mv_build'")
+    available = create_analytic_views(cursor)
+    _available_views.intersection_update(available)
+    _available_views.update(available)
+
+def _execute_query(sql_query: str, cache_plan: bool = False, limit: int = None):
     """
     Execute a SQL query against the IRPF DuckDB database.
     
     Args:
         sql_query (str): SQL query to execute
+        cache_plan (bool): Reuse the parsed relation for this exact SQL text.
+            Only meant for the fixed queries used by the analytic tools.
+        limit (int, optional): Maximum number of rows to return. Applied on top
+            of the cached relation, so an ORDER BY query runs as a Top-N;
+            ad-hoc queries stop reading the result once it is reached.
         
     Returns:
-        pandas.DataFrame: Result of the query
+        list[dict]: Result rows, one dict per row
     """
-    global duck_conn, config
+    logger.debug(f"query_irpf_db called with query: {sql_query[:50]}...")
+    logger.debug("Current config: %s", config)
     
-    logger.info(f"query_irpf_db called with query: {sql_query[:50]}...")
-    logger.info(f"Current config: {config}")
-    logger.info(f"Current duck_conn: {duck_conn}")
+    pool = _get_cursor_pool()
+    if pool is None:
+        return []
     
+    cursor, relation_cache = pool.get()
     try:
-        # Check if we need to initialize the DuckDB connection
-        if duck_conn is None:
-            logger.info("DuckDB connection is None, initializing...")
-            duck_conn = initialize_db_connection()
-            logger.info(f"After initialization, duck_conn: {duck_conn}")
-            if duck_conn is None:
-                logger.error("Failed to initialize DuckDB connection")
-                return pd.DataFrame()
-        
-        logger.info(f"Executing SQL query using connection: {duck_conn}")
-        result = duck_conn.execute(sql_query).fetchdf()
-        logger.info(f"Query result shape: {result.shape}")
-        return result
+        if cache_plan:
+            relation = relation_cache.get(sql_query)
+            if relation is None:
+                relation = cursor.sql(sql_query)
+                relation_cache[sql_query] = relation
+            if limit is not None:
+                relation = relation.limit(limit)
+            table = relation.fetch_arrow_table()
+        else:
+            # Ad-hoc SQL: read the result batch by batch and stop once the row
+            # limit is reached, so a full scan never materializes in one piece
+            writes = any(
+                statement.type not in _READ_ONLY_STATEMENTS
+                for statement in cursor.extract_statements(sql_query)
+            )
+            reader = cursor.execute(sql_query).fetch_record_batch(QUERY_BATCH_ROWS)
+            rows = []
+            for batch in reader:
+                rows.extend(batch.to_pylist())
+                if limit is not None and len(rows) >= limit:
+                    del rows[limit:]
+                    break
+            if writes:
+                logger.info("Ad-hoc SQL may have changed the data, refreshing aggregates")
+                _refresh_aggregates(cursor)
+            logger.debug(f"Query result rows: {len(rows)}")
+            return rows
+        logger.debug(f"Query result shape: {table.shape}")
+        # Arrow -> Python rows directly, skipping the pandas object columns
+        return table.to_pylist()
     except Exception as e:
+        relation_cache.pop(sql_query, None)
         logger.error(f"Error executing query: {e}")
         logger.exception("Detailed exception information:")
-        return pd.DataFrame()
+        return []
+    finally:
+        pool.put((cursor, relation_cache))
+
+# Tool function for querying the database
+@mcp.tool()
+async def query_irpf_db(sql_query: str, max_rows: int = 10000):
+    """
+    Execute a SQL query against the IRPF DuckDB database. Statements that can
+    modify data also refresh the aggregates used by the analytic tools.
+    
+    Args:
+        sql_query (str): SQL query to execute
+        max_rows (int): Maximum number of rows to return; the rest of the
+            result is not read
+        
+    Returns:
+        dict: "rows" (list[dict], one dict per row) and "truncated" (True when
+            the result had more than max_rows rows and was cut)
+    """
+    # Read one row past the cap: a result of exactly max_rows is not truncated
+    rows = await asyncio.to_thread(_execute_query, sql_query, limit=max_rows + 1)
+    truncated = len(rows) > max_rows
+    if truncated:
+        logger.warning(f"Query result truncated to {max_rows} rows")
+        del rows[max_rows:]
+    return {"rows": rows, "truncated": truncated}
+
+# Fixed queries behind the analytic tools
+SALARY_INCOME_SQL = "SELECT * FROM v_salary_income ORDER BY rendimentos DESC"
+PAYMENTS_BY_CATEGORY_SQL = "SELECT * FROM mv_payments_by_category ORDER BY total_value DESC"
+ASSETS_BY_GRUPO_SQL = "SELECT * FROM mv_assets_by_grupo ORDER BY total_value_2024 DESC"
 
 # Tool function for finding salary income
 @mcp.tool()
-def find_salary_income():
+async def find_salary_income(limit: int = 200):
     """
     Find all salary income records in the database.
     
+    Args:
+        limit (int): Maximum number of records to return, highest income first
+        
     Returns:
-        pandas.DataFrame: Salary income records
-    """
-    query = """
-    SELECT d.file_name, r.nome_fonte_pagadora, r.rendimentos
-    FROM rendimentos_tributaveis_pj r
-    JOIN declarations d ON r.declaration_id = d.declaration_id
-    ORDER BY r.rendimentos DESC
+        list[dict]: Salary income records
     """
     logger.info("Finding salary income")
-    return query_irpf_db(query)
+    return await asyncio.to_thread(_execute_query, SALARY_INCOME_SQL, cache_plan=True, limit=limit)
 
 # Tool function for calculating total payments by category
 @mcp.tool()
-def total_payments_by_category():
+async def total_payments_by_category():
     """
     Calculate total payments by category.
     
     Returns:
-        pandas.DataFrame: Total payments grouped by category
-    """
-    query = """
-    SELECT codigo, SUM(valor_pago) as total_value
-    FROM pagamentos_efetuados
-    GROUP BY codigo
-    ORDER BY total_value DESC
+        list[dict]: Total payments grouped by category
     """
     logger.info("Calculating total payments by category")
-    return query_irpf_db(query)
+    return await asyncio.to_thread(_execute_query, PAYMENTS_BY_CATEGORY_SQL, cache_plan=True)
 
 # Tool function for analyzing assets
 @mcp.tool()
-def analyze_assets():
+async def analyze_assets():
     """
     Analyze assets with detailed statistics.
     
     Returns:
-        pandas.DataFrame: Asset analysis results
-    """
-    query = """
-    SELECT 
-        grupo, 
-        COUNT(*) as count,
-        SUM(valor_2024) as total_value_2024,
-        AVG(valor_2024) as avg_value_2024,
-        MIN(valor_2024) as min_value_2024,
-        MAX(valor_2024) as max_value_2024
-    FROM bens_direitos
-    GROUP BY grupo
-    ORDER BY total_value_2024 DESC
+        list[dict]: Asset analysis results
     """
     logger.info("Analyzing assets")
-    return query_irpf_db(query)
+    return await asyncio.to_thread(_execute_query, ASSETS_BY_GRUPO_SQL, cache_plan=True)
+
+# Tool function for fetching the three analytic summaries in one call
+@mcp.tool()
+async def declaration_summary(limit: int = 200):
+    """
+    Salary income, payments by category and asset analysis in a single call.
+    The three queries run concurrently, each on its own pooled cursor.
+    
+    Args:
+        limit (int): Maximum number of salary income records to return
+        
+    Returns:
+        dict: 'salary_income', 'payments_by_category' and 'assets_by_grupo' row lists
+    """
+    logger.info("Building declaration summary")
+    salary, payments, assets = await asyncio.gather(
+        asyncio.to_thread(_execute_query, SALARY_INCOME_SQL, cache_plan=True, limit=limit),
+        asyncio.to_thread(_execute_query, PAYMENTS_BY_CATEGORY_SQL, cache_plan=True),
+        asyncio.to_thread(_execute_query, ASSETS_BY_GRUPO_SQL, cache_plan=True),
+    )
+    return {
+        "salary_income": salary,
+        "payments_by_category": payments,
+        "assets_by_grupo": assets,
+    }
 
 # Tool function for finding all income sources
 @mcp.tool()
-def all_income_sources():
+async def all_income_sources(limit: int = 200):
     """
     Find all income sources across different categories.
     
+    Args:
+        limit (int): Maximum number of income sources to return, highest value first
+        
     Returns:
-        pandas.DataFrame: All income sources
+        list[dict]: All income sources
     """
     logger.info("all_income_sources called")
     
-    # First check if tables exist
-    check_query = """SELECT table_name FROM information_schema.tables 
-                   WHERE table_schema='main' AND 
-                   table_name IN ('rendimentos_tributaveis_pj', 'rendimentos_exclusivos', 'rendimentos_isentos');"""
-    
-    logger.info("Checking if tables exist...")
-    tables_df = query_irpf_db(check_query)
-    logger.info(f"Tables found: {tables_df}")
-    
-    if tables_df.empty:
-        logger.warning("No tables found in database")
-        # Try to list all tables
-        all_tables = query_irpf_db("SELECT table_name FROM information_schema.tables WHERE table_schema='main'")
-        logger.info(f"All tables in database: {all_tables}")
-        return pd.DataFrame({'mensagem': ['Nenhuma tabela de receitas encontrada no banco de dados']})
+    # The view is only built when the income tables exist; opening the pool
+    # first makes sure the views were attempted on this connection
+    if await asyncio.to_thread(_get_cursor_pool) is None:
+        return []
+    if "v_all_income_sources" not in _available_views:
+        logger.warning("No income tables found in database")
+        return [{'mensagem': 'Nenhuma tabela de receitas encontrada no banco de dados'}]
     
+    # Isentos without a paying source are totals, not sources: leave them out
     query = """
-    WITH 
-    tributaveis AS (
-        SELECT 
-            'Tributável PJ' as tipo, 
-            nome_fonte_pagadora as fonte, 
-            rendimentos as valor 
-        FROM rendimentos_tributaveis_pj
-    ),
-    exclusivos AS (
-        SELECT 
-            'Exclusivo' as tipo, 
-            nome_fonte_pagadora as fonte, 
-            valor 
-        FROM rendimentos_exclusivos
-    ),
-    isentos AS (
-        SELECT 
-            'Isento' as tipo, 
-            nome_fonte_pagadora as fonte, 
-            valor 
-        FROM rendimentos_isentos
-        WHERE nome_fonte_pagadora IS NOT NULL
-    )
-    
-    SELECT * FROM tributaveis
-    UNION ALL 
-    SELECT * FROM exclusivos
-    UNION ALL 
-    SELECT * FROM isentos
+    SELECT * FROM v_all_income_sources
+    WHERE tipo <> 'Isento' OR fonte IS NOT NULL
     ORDER BY valor DESC
     """
-    logger.info("Executing income sources query")
-    result = query_irpf_db(query)
-    logger.info(f"Income sources query result: {result}")
+    result = await asyncio.to_thread(_execute_query, query, cache_plan=True, limit=limit)
+    logger.debug("Income sources query result: %s", result)
     return result
 
+def _ensure_chroma_initialized():
+    """
+    Lazily initialize the ChromaDB client, at most once across concurrent calls.
+    
+    Returns:
+        bool: True if the query engine is available
+    """
+    if query_engine is None:
+        with _chroma_lock:
+            if query_engine is None:
+                logger.info("Query engine not initialized, attempting to initialize...")
+                initialize_chroma_client()
+    return query_engine is not None
+
+def _format_chroma_results(queries, results):
+    """
+    Turn a ChromaDB query result into one list of passages per query.
+    LlamaIndex bookkeeping metadata (keys starting with '_') is dropped.
+    """
+    formatted = []
+    for i, query in enumerate(queries):
+        passages = []
+        for text, metadata, distance in zip(
+            results["documents"][i], results["metadatas"][i], results["distances"][i]
+        ):
+            passages.append({
+                "text": text,
+                "metadata": {k: v for k, v in (metadata or {}).items() if not k.startswith("_")},
+                "distance": distance,
+            })
+        formatted.append({"query": query, "passages": passages})
+    return formatted
+
+# Rows converted back to float32 per block during a search, bounding the
+# temporary copy of the int8 codes to FLAT_INDEX_BLOCK x dim floats
+FLAT_INDEX_BLOCK = 4096
+
+def _get_flat_index():
+    """
+    Load every embedding of the collection once into an in-memory index.
+    The knowledge base has a few thousand chunks at most, where one exact
+    matrix product beats an HNSW search. Vectors are kept as int8 codes with
+    a float32 scale per row (a quarter of the float32 footprint); norms are
+    taken from the original vectors. ChromaDB stays the source of truth: the
+    copy is dropped whenever the client is (re)initialized.
+    """
+    global _flat_index
+    
+    if _flat_index is None:
+        with _flat_index_lock:
+            if _flat_index is None:
+                import numpy as np
+                
+                data = chroma_collection.get(include=["embeddings", "documents", "metadatas"])
+                matrix = np.asarray(data["embeddings"], dtype=np.float32)
+                if matrix.ndim != 2:
+                    matrix = matrix.reshape(0, 0)
+                scales = np.abs(matrix).max(axis=1, initial=0.0) / 127.0
+                scales[scales == 0] = 1.0
+                _flat_index = {
+                    "codes": np.rint(matrix / scales[:, None]).astype(np.int8),
+                    "scales": scales.astype(np.float32),
+                    "sq_norms": np.einsum("ij,ij->i", matrix, matrix),
+                    "documents": data["documents"],
+                    "metadatas": data["metadatas"],
+                    # Same distance the collection's HNSW index reports
+                    "space": (chroma_collection.metadata or {}).get("hnsw:space", "l2"),
+                }
+    return _flat_index
+
+def _flat_index_query(query_embeddings, k):
+    """
+    Top-k search over the in-memory index. Returns the same layout as
+    chroma_collection.query(include=["documents", "metadatas", "distances"]).
+    """
+    import numpy as np
+    
+    flat = _get_flat_index()
+    queries = np.asarray(query_embeddings, dtype=np.float32)
+    results = {"documents": [], "metadatas": [], "distances": []}
+    k = min(k, len(flat["documents"]))
+    if k <= 0:
+        for _ in queries:
+            results["documents"].append([])
+            results["metadatas"].append([])
+            results["distances"].append([])
+        return results
+    
+    # Queries stay in float32; only the stored side is quantized
+    codes = flat["codes"]
+    dots = np.empty((len(queries), len(codes)), dtype=np.float32)
+    for start in range(0, len(codes), FLAT_INDEX_BLOCK):
+        block = codes[start:start + FLAT_INDEX_BLOCK].astype(np.float32)
+        dots[:, start:start + len(block)] = queries @ block.T
+    dots *= flat["scales"][None, :]
+    
+    if flat["space"] == "cosine":
+        norms = np.sqrt(flat["sq_norms"]) * np.linalg.norm(queries, axis=1)[:, None]
+        distances = 1.0 - dots / np.maximum(norms, 1e-12)
+    elif flat["space"] == "ip":
+        distances = 1.0 - dots
+    else:  # squared L2, ChromaDB's default
+        distances = flat["sq_norms"][None, :] + np.einsum("ij,ij->i", queries, queries)[:, None] - 2.0 * dots
+    
+    top = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    for row, candidates in enumerate(top):
+        order = candidates[np.argsort(distances[row, candidates])]
+        results["documents"].append([flat["documents"][i] for i in order])
+        results["metadatas"].append([flat["metadatas"][i] for i in order])
+        results["distances"].append(distances[row, order].tolist())
+    return results
+
+def _reinitialize_chroma_client(failed_engine):
+    """
+    Rebuild the ChromaDB client after a failed query, retrying with exponential
+    backoff (immediately, then after 50 ms and 100 ms). Callers that failed on
+    the same engine rebuild it only once; the others reuse the fresh engine.
+    """
+    with _chroma_lock:
+        if query_engine is not failed_engine:
+            return
+        
+        # Clean up existing client if it exists
+        if chroma_client is not None:
+            with contextlib.suppress(Exception):
+                chroma_client.close()
+        
+        for attempt in range(3):
+            if attempt:
+                time.sleep(0.05 * 2 ** (attempt - 1))
+            initialize_chroma_client()
+            if query_engine is not None:
+                return
+
+# Answers already synthesized by query_kb, keyed by the normalized query text.
+# A repeated question skips the embedding request, the vector search and the
+# LLM call; entries expire after KB_CACHE_TTL seconds.
+KB_CACHE_SIZE = 512
+KB_CACHE_TTL = 3600
+_kb_answer_cache = OrderedDict()
+_kb_cache_lock = threading.Lock()
+
+def _kb_cache_key(query):
+    return hashlib.sha256(" ".join(query.split()).lower().encode("utf-8")).hexdigest()
+
+def _kb_cache_get(key):
+    with _kb_cache_lock:
+        entry = _kb_answer_cache.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > KB_CACHE_TTL:
+            del _kb_answer_cache[key]
+            return None
+        _kb_answer_cache.move_to_end(key)
+        return entry[1]
+
+def _kb_cache_put(key, answer):
+    with _kb_cache_lock:
+        _kb_answer_cache[key] = (time.monotonic(), answer)
+        _kb_answer_cache.move_to_end(key)
+        while len(_kb_answer_cache) > KB_CACHE_SIZE:
+            _kb_answer_cache.popitem(last=False)
+
+# Query embeddings, keyed like the answer cache and stored as float32 arrays
+# (~12 KB each for text-embedding-3-large). Shared by query_kb and
+# query_kb_retrieve, so a question asked through both is embedded once.
+EMBEDDING_CACHE_SIZE = 1024
+_query_embedding_cache = OrderedDict()
+_embedding_cache_lock = threading.Lock()
+
+async def _get_query_embedding(query):
+    key = _kb_cache_key(query)
+    with _embedding_cache_lock:
+        cached = _query_embedding_cache.get(key)
+        if cached is not None:
+            _query_embedding_cache.move_to_end(key)
+            return cached.tolist()
+    
+    embedding = await embed_model.aget_query_embedding(query)
+    with _embedding_cache_lock:
+        _query_embedding_cache[key] = array("f", embedding)
+        _query_embedding_cache.move_to_end(key)
+        while len(_query_embedding_cache) > EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+    return embedding
+
 # Tool function for querying the knowledge base
 @mcp.tool()
-def query_kb(query: str):
+async def query_kb(query: str):
     """
     Query the IRPF knowledge base.
     
@@ -364,44 +731,110 @@ def query_kb(query: str):
     try:
         logger.info(f"Querying knowledge base: {query}")
         
+        cache_key = _kb_cache_key(query)
+        answer = _kb_cache_get(cache_key)
+        if answer is not None:
+            logger.debug("Knowledge base answer served from cache")
+            return answer
+        
         # Check if we need to initialize the ChromaDB client
-        if query_engine is None:
-            logger.info("Query engine not initialized, attempting to initialize...")
-            initialize_chroma_client()
-            if query_engine is None:
-                return "Error: Unable to initialize knowledge base query engine"
+        if not await asyncio.to_thread(_ensure_chroma_initialized):
+            return "Error: Unable to initialize knowledge base query engine"
         
-        # Use the pre-initialized query engine
-        response = query_engine.query(query)
-        return str(response)
+        # Hand the engine a precomputed embedding so the retriever skips its own
+        # embedding request; aquery awaits the LLM call instead of blocking
+        from llama_index.core import QueryBundle
+        query_bundle = QueryBundle(query_str=query, embedding=await _get_query_embedding(query))
+        response = await query_engine.aquery(query_bundle)
+        answer = str(response)
+        _kb_cache_put(cache_key, answer)
+        return answer
     except Exception as e:
         logger.error(f"Error querying knowledge base: {e}")
+        failed_engine = query_engine
         
         # Try to reinitialize if there was an error
         try:
             logger.info("Attempting to reinitialize ChromaDB client after error...")
-            # Clean up existing client if it exists
-            if chroma_client is not None:
-                try:
-                    chroma_client.close()
-                except:
-                    pass
-            
-            # Reinitialize
-            time.sleep(1)  # Brief pause before reconnecting
-            initialize_chroma_client()
+            await asyncio.to_thread(_reinitialize_chroma_client, failed_engine)
             
             if query_engine is not None:
                 logger.info("Successfully reinitialized ChromaDB client")
-                response = query_engine.query(query)
-                return str(response)
+                response = await query_engine.aquery(query)
+                answer = str(response)
+                _kb_cache_put(_kb_cache_key(query), answer)
+                return answer
         except Exception as reinit_error:
             logger.error(f"Error reinitializing ChromaDB client: {reinit_error}")
         
         return f"Error querying knowledge base: {str(e)}"
 
-# Initialize connections
-initialize_chroma_client()
+# Tool function for retrieving passages without LLM synthesis
+@mcp.tool()
+async def query_kb_retrieve(query: str, k: int = 5):
+    """
+    Retrieve the most relevant knowledge base passages for a query. Skips the
+    LLM answer synthesis done by query_kb, so it returns in the time of one
+    embedding request plus the vector search.
+    
+    Args:
+        query (str): The query to search in the knowledge base
+        k (int): Number of passages to return
+        
+    Returns:
+        dict: The retrieved passages with metadata and distance
+    """
+    try:
+        logger.info(f"Retrieving passages from knowledge base: {query}")
+        if not await asyncio.to_thread(_ensure_chroma_initialized):
+            return {"error": "Unable to initialize knowledge base"}
+        
+        embedding = await _get_query_embedding(query)
+        results = await asyncio.to_thread(_flat_index_query, [embedding], k)
+        return _format_chroma_results([query], results)[0]
+    except Exception as e:
+        logger.error(f"Error retrieving from knowledge base: {e}")
+        return {"error": f"Error querying knowledge base: {str(e)}"}
+
+# Tool function for retrieving passages for several queries at once
+@mcp.tool()
+async def query_kb_batch(queries: list[str], k: int = 5):
+    """
+    Retrieve the most relevant knowledge base passages for several queries at once.
+    The queries are embedded concurrently through the same cached query
+    embedding as query_kb_retrieve, so both rank a question the same way, and
+    are matched in one pass over the in-memory index; no LLM answer is synthesized.
+    
+    Args:
+        queries (list[str]): The queries to search in the knowledge base
+        k (int): Number of passages to return per query
+        
+    Returns:
+        list[dict]: For each query, the retrieved passages with metadata and
+            distance; on failure, a single {"error": ...} entry
+    """
+    try:
+        logger.info(f"Batch querying knowledge base with {len(queries)} queries")
+        if not queries:
+            return []
+        if not await asyncio.to_thread(_ensure_chroma_initialized):
+            return [{"error": "Unable to initialize knowledge base"}]
+        
+        # One embedding per distinct query; repeats and cached queries cost nothing
+        unique_queries = list(dict.fromkeys(queries))
+        unique_embeddings = await asyncio.gather(*(_get_query_embedding(q) for q in unique_queries))
+        by_query = dict(zip(unique_queries, unique_embeddings))
+        embeddings = [by_query[q] for q in queries]
+        results = await asyncio.to_thread(_flat_index_query, embeddings, k)
+        return _format_chroma_results(queries, results)
+    except Exception as e:
+        logger.error(f"Error batch querying knowledge base: {e}")
+        return [{"error": f"Error querying knowledge base: {str(e)}"}]
+
+# Initialize connections. The knowledge base warms up in a background thread so
+# the MCP handshake isn't held up by the embedding client and the Chroma open;
+# a knowledge base tool called meanwhile waits on _chroma_lock.
+threading.Thread(target=_ensure_chroma_initialized, name="chroma-init", daemon=True).start()
 duck_conn = initialize_db_connection()
 
 if __name__ == "__main__":
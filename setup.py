@@ -2,20 +2,27 @@
 """
 IRPF MCP Setup Script
 
-This script performs all the initialization tasks needed before running server_minimal.py:
+This script performs all the initialization tasks needed before running server.py:
 1. Creates and updates the knowledge base
 2. Processes new personal documents
 3. Initializes database connections
 4. Ensures all necessary directories exist
 
 Run this script during initial setup or whenever there are new files in the input folders,
-before starting the server_minimal.py.
+before starting server.py.
 """
 
+import json
 import logging
 import sys
 import yaml
+try:
+    # libyaml C bindings when available; same semantics as yaml.safe_load
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import duckdb
 import chromadb
@@ -34,6 +41,16 @@ logging.basicConfig(
 )
 logger = logging.getLogger("IRPF_MCP_Setup")
 
+# Project paths, resolved once at import
+PROJECT_ROOT = Path(__file__).resolve().parent
+KB_PATH = PROJECT_ROOT / "knowledge_base" / "chroma_db"
+MEUS_ARQUIVOS_DIR = PROJECT_ROOT / "meus_arquivos"
+ORIGINAIS_DIR = MEUS_ARQUIVOS_DIR / "originais"
+DATA_FILES_DIR = MEUS_ARQUIVOS_DIR / "data_files"
+# Result of the last successful ChromaDB verification
+SETUP_STATE_PATH = PROJECT_ROOT / "knowledge_base" / ".setup_state.json"
+SETUP_STATE_MAX_AGE = 24 * 60 * 60  # seconds
+
 def load_config(config_path: str = "setup.yaml"):
     """
     Load configuration from YAML file.
@@ -45,8 +62,9 @@ def load_config(config_path: str = "setup.yaml"):
         Dict containing configuration values
     """
     try:
-        with open(config_path, "r", encoding="utf-8") as file:
-            config = yaml.safe_load(file)
+        # Binary handle: the loader decodes the UTF-8 bytes itself
+        with open(config_path, "rb") as file:
+            config = yaml.load(file, Loader=SafeLoader)
         logger.info(f"Configuration loaded from {config_path}")
         return config
     except Exception as e:
@@ -75,18 +93,16 @@ def initialize_knowledge_base():
     try:
         from knowledge_base.create_kb import create_knowledge_base
         
-        kb_path = Path("knowledge_base/chroma_db")
-        if not kb_path.exists() or not any(kb_path.iterdir()):
+        if not KB_PATH.exists() or not any(KB_PATH.iterdir()):
             logger.info("Knowledge base not found or empty. Creating new knowledge base...")
             create_knowledge_base()
             logger.info("Knowledge base created successfully")
         else:
-            logger.info(f"Knowledge base found at {kb_path}")
+            logger.info(f"Knowledge base found at {KB_PATH}")
     except Exception as e:
         logger.error(f"Error initializing knowledge base: {e}")
         # Create a minimal knowledge base structure if the import fails
-        kb_path = Path("knowledge_base/chroma_db")
-        kb_path.mkdir(parents=True, exist_ok=True)
+        KB_PATH.mkdir(parents=True, exist_ok=True)
         logger.info("Created minimal knowledge base structure")
 
 def process_personal_documents():
@@ -97,9 +113,7 @@ def process_personal_documents():
         from meus_arquivos.db_arquivos_pessoais import process_personal_documents
         
         logger.info("Checking for personal documents...")
-        # Get the absolute path to the meus_arquivos directory
-        meus_arquivos_path = Path(__file__).parent / "meus_arquivos"
-        processed = process_personal_documents(source_folder=meus_arquivos_path)
+        processed = process_personal_documents(source_folder=MEUS_ARQUIVOS_DIR)
         
         if processed:
             logger.info("Personal documents processed successfully")
@@ -109,11 +123,36 @@ def process_personal_documents():
     except Exception as e:
         logger.error(f"Error processing personal documents: {e}")
         # Create the necessary directories if they don't exist
-        originais_dir = Path(__file__).parent / "meus_arquivos/originais"
-        data_files_dir = Path(__file__).parent / "meus_arquivos/data_files"
-        originais_dir.mkdir(parents=True, exist_ok=True)
-        data_files_dir.mkdir(parents=True, exist_ok=True)
-        logger.info(f"Created directories {originais_dir} and {data_files_dir}")
+        ORIGINAIS_DIR.mkdir(parents=True, exist_ok=True)
+        DATA_FILES_DIR.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Created directories {ORIGINAIS_DIR} and {DATA_FILES_DIR}")
+
+DECLARATIONS_DDL = """
+CREATE TABLE IF NOT EXISTS declarations (
+    declaration_id INTEGER PRIMARY KEY,
+    file_name TEXT,
+    cpf TEXT,
+    year INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);"""
+
+# Tables holding the rows of one declaration: (name, columns between the
+# shared id/declaration_id keys and the foreign key)
+DETAIL_TABLES = [
+    ("rendimentos_tributaveis_pj", "nome_fonte_pagadora TEXT, cnpj_fonte TEXT, rendimentos DECIMAL(15,2)"),
+    ("rendimentos_exclusivos", "nome_fonte_pagadora TEXT, cnpj_fonte TEXT, valor DECIMAL(15,2)"),
+    ("rendimentos_isentos", "nome_fonte_pagadora TEXT, cnpj_fonte TEXT, valor DECIMAL(15,2)"),
+    ("pagamentos_efetuados", "codigo TEXT, nome_beneficiario TEXT, cpf_cnpj_beneficiario TEXT, valor_pago DECIMAL(15,2)"),
+    ("bens_direitos", "codigo TEXT, grupo TEXT, descricao TEXT, valor_2023 DECIMAL(15,2), valor_2024 DECIMAL(15,2)"),
+]
+
+DETAIL_TABLE_TEMPLATE = """
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    declaration_id INTEGER,
+    {cols},
+    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
+);"""
 
 def initialize_db_connection(config):
     """
@@ -133,82 +172,15 @@ def initialize_db_connection(config):
         conn = duckdb.connect(str(duck_db_path))
         logger.info(f"Connected to DuckDB at {duck_db_path}")
         
-        # Check if tables exist and create them if needed
+        # All tables in one multi-statement call; IF NOT EXISTS makes it
+        # idempotent, so no existence probe is needed
+        ddl = "\n".join(
+            [DECLARATIONS_DDL]
+            + [DETAIL_TABLE_TEMPLATE.format(name=name, cols=cols) for name, cols in DETAIL_TABLES]
+        )
         try:
-            # Check if the declarations table exists
-            result = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='declarations'").fetchall()
-            if not result:
-                logger.info("Creating database tables...")
-                # Create tables (simplified schema)
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS declarations (
-                    declaration_id INTEGER PRIMARY KEY,
-                    file_name TEXT,
-                    cpf TEXT,
-                    year INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-                """)
-                
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS rendimentos_tributaveis_pj (
-                    id INTEGER PRIMARY KEY,
-                    declaration_id INTEGER,
-                    nome_fonte_pagadora TEXT,
-                    cnpj_fonte TEXT,
-                    rendimentos DECIMAL(15,2),
-                    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
-                )
-                """)
-                
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS rendimentos_exclusivos (
-                    id INTEGER PRIMARY KEY,
-                    declaration_id INTEGER,
-                    nome_fonte_pagadora TEXT,
-                    cnpj_fonte TEXT,
-                    valor DECIMAL(15,2),
-                    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
-                )
-                """)
-                
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS rendimentos_isentos (
-                    id INTEGER PRIMARY KEY,
-                    declaration_id INTEGER,
-                    nome_fonte_pagadora TEXT,
-                    cnpj_fonte TEXT,
-                    valor DECIMAL(15,2),
-                    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
-                )
-                """)
-                
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS pagamentos_efetuados (
-                    id INTEGER PRIMARY KEY,
-                    declaration_id INTEGER,
-                    codigo TEXT,
-                    nome_beneficiario TEXT,
-                    cpf_cnpj_beneficiario TEXT,
-                    valor_pago DECIMAL(15,2),
-                    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
-                )
-                """)
-                
-                conn.execute("""
-                CREATE TABLE IF NOT EXISTS bens_direitos (
-                    id INTEGER PRIMARY KEY,
-                    declaration_id INTEGER,
-                    codigo TEXT,
-                    grupo TEXT,
-                    descricao TEXT,
-                    valor_2023 DECIMAL(15,2),
-                    valor_2024 DECIMAL(15,2),
-                    FOREIGN KEY (declaration_id) REFERENCES declarations(declaration_id)
-                )
-                """)
-                
-                logger.info("Database tables created successfully")
+            conn.execute(f"BEGIN TRANSACTION;\n{ddl}\nCOMMIT;")
+            logger.info("Database tables verified")
         except Exception as table_error:
             logger.error(f"Error creating database tables: {table_error}")
         
@@ -222,14 +194,30 @@ def initialize_db_connection(config):
 def initialize_chroma_client():
     """
     Initialize the ChromaDB client to verify it's working correctly.
+    
+    The full check (embedding model, vector store, index) is skipped when the
+    collection still has the document count recorded by a verification less
+    than SETUP_STATE_MAX_AGE seconds old; only a heartbeat is sent then.
     """
     try:
+        # Connect to existing ChromaDB
+        chroma_client = chromadb.PersistentClient(path=str(KB_PATH))
+        chroma_collection = chroma_client.get_or_create_collection("IRPF")
+        collection_count = chroma_collection.count()
+        
+        try:
+            state = json.loads(SETUP_STATE_PATH.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            state = {}
+        if (state.get("collection_count") == collection_count
+                and time.time() - state.get("verified_at", 0) < SETUP_STATE_MAX_AGE):
+            chroma_client.heartbeat()
+            logger.info("ChromaDB collection unchanged since the last verification, skipped index check")
+            return True
+        
         # Initialize embedding model
         embed_model = OpenAIEmbedding(model="text-embedding-3-large")
         
-        # Connect to existing ChromaDB
-        chroma_client = chromadb.PersistentClient(path="knowledge_base/chroma_db")
-        chroma_collection = chroma_client.get_or_create_collection("IRPF")
         vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         index = VectorStoreIndex.from_vector_store(
             vector_store,
@@ -237,6 +225,10 @@ def initialize_chroma_client():
         )
         query_engine = index.as_query_engine()
         
+        SETUP_STATE_PATH.write_text(
+            json.dumps({"collection_count": collection_count, "verified_at": time.time()}),
+            encoding="utf-8",
+        )
         logger.info("ChromaDB client initialized and verified successfully")
         return True
     except Exception as e:
@@ -247,10 +239,12 @@ def add_to_python_path():
     """
     Add the project root to the Python path to enable imports.
     """
-    project_root = Path(__file__).parent
-    if str(project_root) not in sys.path:
-        sys.path.append(str(project_root))
-        logger.info(f"Added {project_root} to Python path")
+    if str(PROJECT_ROOT) not in sys.path:
+        sys.path.append(str(PROJECT_ROOT))
+        logger.info(f"Added {PROJECT_ROOT} to Python path")
+
+# Run once at import, before any of the project modules are imported lazily
+add_to_python_path()
 
 def main():
     """
@@ -258,23 +252,25 @@ def main():
     """
     print("🚀 Starting IRPF MCP Setup...")
     
-    # Add to Python path
-    add_to_python_path()
-    
     # Load configuration
     config = load_config()
     
-    # Initialize knowledge base
-    initialize_knowledge_base()
-    
-    # Process personal documents
-    process_personal_documents()
+    def knowledge_base_chain():
+        initialize_knowledge_base()
+        return initialize_chroma_client()
     
-    # Initialize database
-    db_initialized = initialize_db_connection(config)
+    def database_chain():
+        process_personal_documents()
+        return initialize_db_connection(config)
     
-    # Verify ChromaDB client
-    chroma_initialized = initialize_chroma_client()
+    # Two independent chains: the Chroma check needs the knowledge base built,
+    # and the table DDL must not race the personal-documents rebuild on the
+    # same DuckDB file, but neither chain touches the other's store
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        chroma_future = executor.submit(knowledge_base_chain)
+        db_future = executor.submit(database_chain)
+        chroma_initialized = chroma_future.result()
+        db_initialized = db_future.result()
     
     # Final status
     if db_initialized and chroma_initialized:
@@ -15,30 +15,21 @@ Usage
 from __future__ import annotations
 
 from lxml import etree as ET
-from decimal import Decimal
 from pathlib import Path
-from typing import Dict, List
+from functools import lru_cache
+from typing import Dict
 from datetime import date
 
-from IRPF_schema import (
-    BemDireito,
-    DeclaracaoIRPF2025,
-    DoacaoEfetuada,
-    Money,
-    PagamentoEfetuado,
-    RendExclusivo,
-    RendIsento,
-    RendTribPJ,
-    Summary)
+from IRPF_schema import DeclaracaoIRPF2025
 
 # ────────────────────────────────────────────────────────────────────────────────
 #  Helpers
 # ────────────────────────────────────────────────────────────────────────────────
 
-def parse_money(raw: str | None) -> Money:
+def parse_money(raw: str | None) -> str:
+    """Turn '1.234,56' into '1234.56'; the Money fields parse it during validation."""
     raw = (raw or "0,00").strip()
-    clean = raw.replace(".", "").replace(",", ".")
-    return Money(Decimal(clean))
+    return raw.replace(".", "").replace(",", ".")
 
 
 
@@ -50,10 +41,18 @@ BENEFICIARIO_MAP: Dict[str, TitDepAli] = {
 }
 
 
+# Same map with lowercase flags too, so lookups skip the .upper() call
+_BENEFICIARIO_LOOKUP: Dict[str, TitDepAli] = {
+    **BENEFICIARIO_MAP,
+    **{flag.lower(): value for flag, value in BENEFICIARIO_MAP.items()},
+}
+
+
 def beneficiario_from_flag(flag: str | None) -> TitDepAli:
-    return BENEFICIARIO_MAP.get((flag or "T").upper(), "titular")  # default titular
+    return _BENEFICIARIO_LOOKUP.get(flag or "T", "titular")  # default titular
 
 
+@lru_cache(maxsize=512)
 def normalise_codigo(cod: str) -> str:
     """Pad codes with zeros so they always have two digits ('1' → '01')."""
     return cod.zfill(2) if cod else cod
@@ -67,138 +66,122 @@ def normalise_codigo(cod: str) -> str:
 def first_attrib(el: ET.Element, *attrs: str, default: str | None = None) -> str | None:
     """Return the first non-empty attribute among *attrs* (or *default*)."""
     for a in attrs:
-        v = el.attrib.get(a)
+        v = el.get(a)
         if v:
             return v
     return default
 
 
 # ────────────────────────────────────────────────────────────────────────────────
-#  Parsers for each schedule
+#  Parsers for each schedule (one <item> at a time, as plain dicts)
 # ────────────────────────────────────────────────────────────────────────────────
 
 
-def parse_bens(root: ET.Element, ns: dict[str, str]) -> list[BemDireito]:
-    bens: list[BemDireito] = []
-    for item in root.findall(".//rf:bens/rf:item", ns):
-        grupo  = (item.attrib.get("grupo")  or "").strip()
-        codigo = (item.attrib.get("codigo") or "").strip()
-
-        # se for o placeholder vazio, apenas atribua códigos neutros
-        if not grupo or not codigo:
-            grupo  = grupo  or "00"
-            codigo = codigo or "00"
-
-        bens.append(
-            BemDireito(
-                grupo=normalise_codigo(grupo),
-                codigo=normalise_codigo(codigo),
-                pais=item.attrib.get("pais", "105"),
-                discriminacao=(item.attrib.get("discriminacao") or "").strip(),
-                situacao_31_12_2023=parse_money(item.attrib.get("valorExercicioAnterior")),
-                situacao_31_12_2024=parse_money(item.attrib.get("valorExercicioAtual")),
-                repetir_valor=False,
-            )
-        )
-
-    return bens
-
-def parse_pagamentos(root: ET.Element, ns: Dict[str, str]) -> List[PagamentoEfetuado]:
-    pags: List[PagamentoEfetuado] = []
-    for item in root.findall(".//rf:pagamentos/rf:item", ns):
-        cpf_beneficiario = first_attrib(item, "cpfBeneficiario", "niBeneficiario", "cpfPrestador", default="00000000000")
-        pags.append(
-            PagamentoEfetuado(
-                codigo=normalise_codigo(item.attrib.get("codigo", "")),
-                pessoa_beneficiada=beneficiario_from_flag(item.attrib.get("tipo")),
-                cpf_beneficiario=cpf_beneficiario,
-                cpf_cnpj_prestador=first_attrib(item, "niBeneficiario", "cpfPrestador"),
-                nome_prestador=first_attrib(item, "nomeBeneficiario", "nomePrestador"),
-                nome_beneficiario=first_attrib(item, "nomeBeneficiario"),
-                descricao=item.attrib.get("descricao") or None,
-                valor_pago=parse_money(item.attrib.get("valorPago")),
-                parcela_nao_dedutivel=parse_money(item.attrib.get("parcelaNaoDedutivel")),
-            )
-        )
-    return pags
-
-
-def parse_doacoes(root: ET.Element, ns: Dict[str, str]) -> List[DoacaoEfetuada]:
-    doacoes: List[DoacaoEfetuada] = []
-    for item in root.findall(".//rf:doacoes/rf:item", ns):
-        doacoes.append(
-            DoacaoEfetuada(
-                codigo=item.attrib.get("codigo", ""),
-                cnpj_proponente=item.attrib.get("cnpjProponente"),
-                nome_proponente=item.attrib.get("nomeProponente"),
-                valor_pago=parse_money(item.attrib.get("valorPago")),
-            )
-        )
-    return doacoes
-
-
-def parse_rend_trib_pj(root: ET.Element, ns: Dict[str, str]) -> List[RendTribPJ]:
-    rend: List[RendTribPJ] = []
-    titular_path = ".//rf:colecaoRendPJTitular/rf:item"
-    depend_path = ".//rf:colecaoRendPJDependente/rf:item"
-    for item in root.findall(f"{titular_path}|{depend_path}", ns):
-        cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
-        rend.append(
-            RendTribPJ(
-                cpf_cnpj_fonte_pagadora=item.attrib["NIFontePagadora"],
-                nome_fonte_pagadora=item.attrib["nomeFontePagadora"],
-                cpf_beneficiario=cpf_beneficiario,
-                beneficiario=item.attrib.get("cpfBeneficiario"),
-                rendimentos=parse_money(item.attrib.get("rendRecebidoPJ")),
-                contribuicao_previdenciaria=parse_money(
-                    item.attrib.get("contribuicaoPrevOficial")
-                ),
-                imposto_retido=parse_money(item.attrib.get("impostoRetidoFonte")),
-                decimo_terceiro=parse_money(item.attrib.get("decimoTerceiro")),
-                irrf_decimo_terceiro=parse_money(item.attrib.get("IRRFDecimoTerceiro")),
-            )
-        )
-    return rend
-
-
-def parse_rend_isentos(root: ET.Element, ns: dict[str, str]) -> list[RendIsento]:
-    isentos: list[RendIsento] = []
-    for quadro in root.findall(".//rf:rendIsentos//*", ns):
-        if quadro.tag.endswith("QuadroAuxiliar"):
-            tipo = quadro.tag.split('}', 1)[-1]
-            for item in quadro.findall("rf:item", ns):
-                cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
-                isentos.append(
-                    RendIsento(
-                        tipo_rendimento=tipo,
-                        tipo_beneficiario=beneficiario_from_flag(item.attrib.get("tipoBeneficiario")),
-                        beneficiario=item.attrib.get("cpfBeneficiario"),
-                        cpf_beneficiario=cpf_beneficiario,
-                        cnpj_fonte_pagadora=item.attrib.get("cnpjEmpresa"),
-                        nome_fonte_pagadora=first_attrib(item, "nomeFonte", "descricaoRendimento"),
-                        valor=parse_money(item.attrib.get("valor")),
-                    )
-                )
-    return isentos
-
-def parse_rend_exclusivos(root: ET.Element, ns: Dict[str, str]) -> List[RendExclusivo]:
-    exclusivos: List[RendExclusivo] = []
-    for section in root.findall(".//rf:rendTributacaoExclusiva", ns):
-        for item in section.findall(".//rf:item", ns):
-            tipo = item.getparent().tag.split("}", 1)[-1]  # e.g. 'rendAplicacoesQuadroAuxiliar'
-            cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
-            exclusivos.append(
-                RendExclusivo(
-                    tipo_rendimento=tipo,
-                    tipo_beneficiario=beneficiario_from_flag(item.attrib.get("tipoBeneficiario")),
-                    beneficiario=item.attrib.get("cpfBeneficiario"),
-                    cpf_beneficiario=cpf_beneficiario,
-                    cnpj_fonte_pagadora=item.attrib.get("cnpjEmpresa"),
-                    nome_fonte_pagadora=item.attrib.get("nomeFonte"),
-                    valor=parse_money(item.attrib.get("valor")),
-                )
-            )
-    return exclusivos
+def parse_bem(item: ET.Element) -> dict:
+    get = item.get
+    grupo  = (get("grupo")  or "").strip()
+    codigo = (get("codigo") or "").strip()
+
+    # se for o placeholder vazio, apenas atribua códigos neutros
+    if not grupo or not codigo:
+        grupo  = grupo  or "00"
+        codigo = codigo or "00"
+
+    return dict(
+        grupo=normalise_codigo(grupo),
+        codigo=normalise_codigo(codigo),
+        pais=get("pais", "105"),
+        discriminacao=(get("discriminacao") or "").strip(),
+        situacao_31_12_2023=parse_money(get("valorExercicioAnterior")),
+        situacao_31_12_2024=parse_money(get("valorExercicioAtual")),
+        repetir_valor=False,
+    )
+
+
+def parse_pagamento(item: ET.Element) -> dict:
+    get = item.get
+    cpf_beneficiario = first_attrib(item, "cpfBeneficiario", "niBeneficiario", "cpfPrestador", default="00000000000")
+    return dict(
+        codigo=normalise_codigo(get("codigo", "")),
+        pessoa_beneficiada=beneficiario_from_flag(get("tipo")),
+        cpf_beneficiario=cpf_beneficiario,
+        cpf_cnpj_prestador=first_attrib(item, "niBeneficiario", "cpfPrestador"),
+        nome_prestador=first_attrib(item, "nomeBeneficiario", "nomePrestador"),
+        nome_beneficiario=first_attrib(item, "nomeBeneficiario"),
+        descricao=get("descricao") or None,
+        valor_pago=parse_money(get("valorPago")),
+        parcela_nao_dedutivel=parse_money(get("parcelaNaoDedutivel")),
+    )
+
+
+def parse_doacao(item: ET.Element) -> dict:
+    get = item.get
+    return dict(
+        codigo=get("codigo", ""),
+        cnpj_proponente=get("cnpjProponente"),
+        nome_proponente=get("nomeProponente"),
+        valor_pago=parse_money(get("valorPago")),
+    )
+
+
+def parse_rend_trib_pj(item: ET.Element) -> dict:
+    attrib = item.attrib  # required attributes: a missing one raises KeyError
+    get = item.get
+    cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
+    return dict(
+        cpf_cnpj_fonte_pagadora=attrib["NIFontePagadora"],
+        nome_fonte_pagadora=attrib["nomeFontePagadora"],
+        cpf_beneficiario=cpf_beneficiario,
+        beneficiario=get("cpfBeneficiario"),
+        rendimentos=parse_money(get("rendRecebidoPJ")),
+        contribuicao_previdenciaria=parse_money(
+            get("contribuicaoPrevOficial")
+        ),
+        imposto_retido=parse_money(get("impostoRetidoFonte")),
+        decimo_terceiro=parse_money(get("decimoTerceiro")),
+        irrf_decimo_terceiro=parse_money(get("IRRFDecimoTerceiro")),
+    )
+
+
+def parse_rend_isento(item: ET.Element, tipo: str) -> dict:
+    get = item.get
+    cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
+    return dict(
+        tipo_rendimento=tipo,
+        tipo_beneficiario=beneficiario_from_flag(get("tipoBeneficiario")),
+        beneficiario=get("cpfBeneficiario"),
+        cpf_beneficiario=cpf_beneficiario,
+        cnpj_fonte_pagadora=get("cnpjEmpresa"),
+        nome_fonte_pagadora=first_attrib(item, "nomeFonte", "descricaoRendimento"),
+        valor=parse_money(get("valor")),
+    )
+
+
+def parse_rend_exclusivo(item: ET.Element, tipo: str) -> dict:
+    get = item.get
+    cpf_beneficiario = first_attrib(item, "cpfBeneficiario", default="00000000000")
+    return dict(
+        tipo_rendimento=tipo,  # e.g. 'rendAplicacoesQuadroAuxiliar'
+        tipo_beneficiario=beneficiario_from_flag(get("tipoBeneficiario")),
+        beneficiario=get("cpfBeneficiario"),
+        cpf_beneficiario=cpf_beneficiario,
+        cnpj_fonte_pagadora=get("cnpjEmpresa"),
+        nome_fonte_pagadora=get("nomeFonte"),
+        valor=parse_money(get("valor")),
+    )
+
+
+# <item> parsers keyed by the collection element that contains them, with the
+# DeclaracaoIRPF2025 field the result goes to. Income items nested in
+# rendIsentos / rendTributacaoExclusiva are matched by path in parse_irpf2025,
+# since their collection name is also their tipo_rendimento.
+ITEM_PARSERS = {
+    "bens": ("bens_direitos", parse_bem),
+    "pagamentos": ("pagamentos_efetuados", parse_pagamento),
+    "doacoes": ("doacoes_efetuadas", parse_doacao),
+    "colecaoRendPJTitular": ("rendimentos_tributaveis_pj", parse_rend_trib_pj),
+    "colecaoRendPJDependente": ("rendimentos_tributaveis_pj", parse_rend_trib_pj),
+}
 
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -207,49 +190,75 @@ def parse_rend_exclusivos(root: ET.Element, ns: Dict[str, str]) -> List[RendExcl
 
 
 def parse_irpf2025(xml_file: str | Path) -> DeclaracaoIRPF2025:
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-
-    # default namespace declared at the root
-    ns = {"rf": root.tag.split("}")[0].strip("{")}
-
-    bens = parse_bens(root, ns)
-    pagamentos = parse_pagamentos(root, ns)
-    doacoes = parse_doacoes(root, ns)
-    rend_trib_pj = parse_rend_trib_pj(root, ns)
-    rend_isentos = parse_rend_isentos(root, ns)
-    rend_exclusivos = parse_rend_exclusivos(root, ns)
+    fichas: dict[str, list[dict]] = {
+        "bens_direitos": [],
+        "doacoes_efetuadas": [],
+        "pagamentos_efetuados": [],
+        "rendimentos_exclusivos": [],
+        "rendimentos_isentos": [],
+        "rendimentos_tributaveis_pj": [],
+    }
+    ident: dict[str, str] | None = None
+    data_text: str | None = None
+
+    # Single streaming pass: each <item> is dispatched by its ancestors and
+    # discarded right away, so the full DOM is never held in memory.
+    path: list[str] = []  # local names of the currently open elements
+    for event, el in ET.iterparse(str(xml_file), events=("start", "end")):
+        tag = el.tag.rpartition("}")[2]
+        if event == "start":
+            path.append(tag)
+            continue
+        path.pop()
+
+        if tag == "item":
+            parent = path[-1] if path else ""
+            handler = ITEM_PARSERS.get(parent)
+            if handler is not None:
+                field, parser = handler
+                fichas[field].append(parser(el))
+            elif "rendIsentos" in path and parent.endswith("QuadroAuxiliar"):
+                fichas["rendimentos_isentos"].append(parse_rend_isento(el, parent))
+            elif "rendTributacaoExclusiva" in path:
+                fichas["rendimentos_exclusivos"].append(parse_rend_exclusivo(el, parent))
+        elif tag == "identificadorDeclaracao" and ident is None:
+            ident = dict(el.attrib)
+        elif tag == "dataDeclaracao" and data_text is None:
+            data_text = el.text or ""
+
+        # Free the element and the already-processed siblings before it
+        # (the root has no parent, but may follow a comment or PI)
+        el.clear(keep_tail=True)
+        parent = el.getparent()
+        if parent is not None:
+            while el.getprevious() is not None:
+                del parent[0]
 
     # Simple one-line summary
-    ident = root.find(".//rf:identificadorDeclaracao", ns)
-    cpf = ident.attrib.get("cpf", "???") if ident is not None else "???"
-    nome = ident.attrib.get("nome", "declarante") if ident is not None else "declarante"
-    resumo = Summary(text=f"Declaração IRPF-2025 de {nome} (CPF {cpf}).")
+    cpf = ident.get("cpf", "???") if ident is not None else "???"
+    nome = ident.get("nome", "declarante") if ident is not None else "declarante"
+    resumo = {"text": f"Declaração IRPF-2025 de {nome} (CPF {cpf})."}
 
     # Get the document date or use current date
     data_doc = date.today()  # Default to today
     
     # Try to extract date from XML if available
-    data_node = root.find(".//rf:dataDeclaracao", ns)
-    if data_node is not None and data_node.text:
+    if data_text:
         try:
             # Assuming format is "YYYY-MM-DD" or similar
-            parts = data_node.text.split("-")
+            parts = data_text.split("-")
             if len(parts) == 3:
                 data_doc = date(int(parts[0]), int(parts[1]), int(parts[2]))
         except (ValueError, IndexError):
             pass  # Keep default date if parsing fails
 
-    return DeclaracaoIRPF2025(
-        bens_direitos=bens,
-        doacoes_efetuadas=doacoes,
-        pagamentos_efetuados=pagamentos,
-        rendimentos_exclusivos=rend_exclusivos,
-        rendimentos_isentos=rend_isentos,
-        rendimentos_tributaveis_pj=rend_trib_pj,
-        summary=resumo,
-        data_documento=data_doc,
-    )
+    # One validation call over the whole tree: pydantic-core validates the
+    # nested schedules in Rust instead of one Python-level model per item
+    return DeclaracaoIRPF2025.model_validate({
+        **fichas,
+        "summary": resumo,
+        "data_documento": data_doc,
+    })
 
 
 # ────────────────────────────────────────────────────────────────────────────────
@@ -257,11 +266,11 @@ def parse_irpf2025(xml_file: str | Path) -> DeclaracaoIRPF2025:
 # ────────────────────────────────────────────────────────────────────────────────
 
 if __name__ == "__main__":
-    import argparse, json
+    import argparse
 
     ap = argparse.ArgumentParser(description="Parse IRPF-2025 XML → JSON")
     ap.add_argument("xmlfile", type=Path)
     args = ap.parse_args()
 
     decl = parse_irpf2025(args.xmlfile)
-    print(json.dumps(decl.model_dump(mode="json"), indent=2, ensure_ascii=False))
\ No newline at end of file
+    print(decl.model_dump_json(indent=2))
\ No newline at end of file